@@ -3,18 +3,28 @@ GCN 微服務 - 擴展版
 提供多種圖神經網路 API 端點
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, Field, Base64Bytes
+from typing import List, Dict, Any, Optional, Callable, Tuple, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import asyncio
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import threading
 import numpy as np
+import scipy.sparse as sp
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
 from model import (
-    SimpleGCN, DeepGCN, GATModel, HybridGCN,
     normalize_adjacency, build_correlation_graph, build_knn_graph,
-    RankingLoss, CombinedLoss, create_model, evaluate_predictions
+    RankingLoss, CombinedLoss, create_model
 )
 import uvicorn
 import logging
@@ -24,10 +34,27 @@ from datetime import datetime
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 小型圖的矩陣運算以單執行緒延遲最低，並避免並發請求間的執行緒爭用
+torch.set_num_threads(1)
+if torch.get_num_interop_threads() != 1:
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError as e:
+        # 宿主行程已啟動平行運算時無法再調整，沿用現有設定
+        logger.warning(f"Cannot set interop threads: {str(e)}")
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """服務啟動時預熱模型比較行程池，關閉時釋放"""
+    warm_compare_pool()
+    yield
+    reset_compare_pool()
+
 app = FastAPI(
     title="GCN 股票分析服務",
     description="基於圖神經網路的股票關係分析與評分服務",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # CORS 設置
@@ -43,10 +70,13 @@ app.add_middleware(
 # 請求/回應模型
 # ============================================
 
+# 特徵矩陣：巢狀串列，或 base64 編碼的 float32（little-endian, row-major）二進位資料
+FeatureMatrix = Union[List[List[float]], Base64Bytes]
+
 class GCNRequest(BaseModel):
     """基本 GCN 預測請求"""
     nodes: List[str]
-    features: List[List[float]]
+    features: FeatureMatrix
     adjacency: List[List[int]]
     train_epochs: int = 0
 
@@ -58,7 +88,7 @@ class GCNResponse(BaseModel):
 class AdvancedGCNRequest(BaseModel):
     """進階 GCN 請求"""
     nodes: List[str]
-    features: List[List[float]]
+    features: FeatureMatrix
     adjacency: Optional[List[List[int]]] = None
     returns: Optional[List[List[float]]] = None  # 用於建立相關性圖
     model_type: str = Field(default="simple", description="模型類型: simple, deep, gat, hybrid")
@@ -73,7 +103,7 @@ class AdvancedGCNRequest(BaseModel):
 class MultiModelRequest(BaseModel):
     """多模型比較請求"""
     nodes: List[str]
-    features: List[List[float]]
+    features: FeatureMatrix
     adjacency: Optional[List[List[int]]] = None
     model_types: List[str] = ["simple", "deep", "gat"]
     train_epochs: int = 50
@@ -82,13 +112,13 @@ class MultiModelRequest(BaseModel):
 class StockClusterRequest(BaseModel):
     """股票聚類請求"""
     nodes: List[str]
-    features: List[List[float]]
+    features: FeatureMatrix
     n_clusters: int = Field(default=5, ge=2, le=20)
 
 class FeatureImportanceRequest(BaseModel):
     """特徵重要性分析請求"""
     nodes: List[str]
-    features: List[List[float]]
+    features: FeatureMatrix
     feature_names: List[str]
     adjacency: List[List[int]]
 
@@ -99,30 +129,101 @@ class FeatureImportanceRequest(BaseModel):
 def build_adj_matrix(n: int, edges: List[List[int]]) -> np.ndarray:
     """建立鄰接矩陣"""
     A = np.zeros((n, n), dtype=np.float32)
-    for e in edges:
-        if len(e) >= 2:
-            i, j = e[0], e[1]
-            if 0 <= i < n and 0 <= j < n:
-                A[i, j] = 1.0
-                A[j, i] = 1.0
+    e = np.array([pair[:2] for pair in edges if len(pair) >= 2], dtype=np.int64).reshape(-1, 2)
+    # 過濾越界的邊後一次寫入
+    valid = ((e >= 0) & (e < n)).all(axis=1)
+    i, j = e[valid, 0], e[valid, 1]
+    A[i, j] = 1.0
+    A[j, i] = 1.0
     # 加入自環
-    for i in range(n):
-        A[i, i] = 1.0
+    np.fill_diagonal(A, 1.0)
     return A
 
-def normalize_adj(A: np.ndarray) -> np.ndarray:
-    """正規化鄰接矩陣"""
-    D = np.sum(A, axis=1)
+def add_self_loops(A):
+    """就地加入自環，不另外配置 N x N 的單位矩陣（稀疏矩陣則只修改對角線）"""
+    if sp.issparse(A):
+        return (A - sp.diags(A.diagonal()) + sp.identity(A.shape[0], dtype=A.dtype)).tocsr()
+    np.fill_diagonal(A, 1.0)
+    return A
+
+def feature_matrix(features: Union[List[List[float]], bytes], n: int) -> np.ndarray:
+    """將請求特徵轉為 [N, F] float32 矩陣；二進位格式直接解讀緩衝區，不經 Python 串列"""
+    if isinstance(features, bytes):
+        if n == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        if len(features) % (4 * n) != 0:
+            raise HTTPException(
+                status_code=422,
+                detail=f"features 位元組長度 {len(features)} 無法整除為 {n} 列 float32"
+            )
+        # bytearray 提供可寫入的緩衝區，供 torch.from_numpy 直接共用
+        return np.frombuffer(bytearray(features), dtype='<f4').reshape(n, -1)
+    try:
+        X = np.array(features, dtype=np.float32)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"features 須為等長數值列組成的矩陣: {str(e)}")
+    if X.ndim != 2:
+        if X.size == 0:
+            return X.reshape(0, 0)
+        raise HTTPException(status_code=422, detail=f"features 須為二維矩陣，收到 {X.ndim} 維")
+    return X
+
+def normalize_adj(A):
+    """正規化鄰接矩陣（支援 NumPy 稠密矩陣與 scipy 稀疏矩陣）"""
+    D = np.asarray(A.sum(axis=1)).ravel()
     D_inv_sqrt = np.where(D > 0, 1.0 / np.sqrt(D), 0.0)
-    D_mat = np.diag(D_inv_sqrt)
-    return D_mat @ A @ D_mat
+    if sp.issparse(A):
+        # 稀疏矩陣只縮放非零值：vals *= d[row] * d[col]
+        A = A.tocsr(copy=True)
+        rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+        A.data *= D_inv_sqrt[rows] * D_inv_sqrt[A.indices]
+        return A
+    # D^(-1/2) A D^(-1/2) 等同逐元素乘上 outer(d, d)，不需建立對角矩陣
+    return A * D_inv_sqrt[:, None] * D_inv_sqrt[None, :]
 
 def normalize_scores(scores: np.ndarray) -> List[float]:
     """正規化分數到 0-100"""
-    s_min, s_max = float(scores.min()), float(scores.max())
+    scores = np.asarray(scores, dtype=np.float64)
+    s_min, s_max = scores.min(), scores.max()
     if s_max - s_min < 1e-6:
-        return [50.0 for _ in scores]
-    return [100.0 * (s - s_min) / (s_max - s_min) for s in scores]
+        return [50.0] * len(scores)
+    return ((scores - s_min) * (100.0 / (s_max - s_min))).tolist()
+
+def edge_index(adj: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """取出鄰接矩陣非零位置的 (row, col) 索引；CSR 直接由結構展開，不經稠密矩陣"""
+    if adj.layout == torch.sparse_csr:
+        row = torch.repeat_interleave(torch.arange(adj.shape[0]), adj.crow_indices().diff())
+        return row, adj.col_indices()
+    row, col = (adj > 0).nonzero(as_tuple=True)
+    return row, col
+
+def prepare_loss(adj: torch.Tensor, loss_type: str, dtype: torch.dtype) -> Dict[str, Any]:
+    """
+    預先計算損失函數中只與圖結構有關的張量，在訓練過程中不變
+    """
+    ctx: Dict[str, Any] = {}
+    if loss_type == "smooth":
+        # 鄰居邊的 (row, col) 索引與度數
+        row, col = edge_index(adj)
+        ctx["neigh_row"], ctx["neigh_col"] = row, col
+        ctx["neigh_deg"] = torch.bincount(row, minlength=adj.shape[0]).to(dtype)
+    elif loss_type == "contrast":
+        # 正樣本配對索引；負樣本於每輪抽樣，只保留正樣本的排序鍵供排除，記憶體 O(nnz)
+        n = adj.shape[0]
+        row, col = edge_index(adj)
+        ctx["pos_idx"] = (row, col)
+        ctx["pos_key"] = torch.sort(row * n + col).values
+        ctx["n_neg"] = max(row.numel(), n) if row.numel() < n * n else 0
+    return ctx
+
+def sample_negatives(loss_ctx: Dict[str, Any], n: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """均勻抽樣 n_neg 個節點配對，並排除其中的正樣本（邊）"""
+    pair = torch.randint(0, n, (2, loss_ctx["n_neg"]))
+    key = pair[0] * n + pair[1]
+    pos_key = loss_ctx["pos_key"]
+    pos = torch.searchsorted(pos_key, key).clamp(max=max(0, pos_key.numel() - 1))
+    keep = pos_key[pos] != key if pos_key.numel() > 0 else torch.ones_like(key, dtype=torch.bool)
+    return pair[0][keep], pair[1][keep]
 
 def train_model(
     model: torch.nn.Module,
@@ -136,7 +237,11 @@ def train_model(
     device = x.device
     optimizer = optim.Adam(model.parameters(), lr=lr)
     
-    training_history = []
+    # 損失先留在裝置上，訓練結束後一次取回，避免每輪同步
+    losses = torch.empty(epochs, device=device)
+    
+    n = adj.shape[0]
+    loss_ctx = prepare_loss(adj, loss_type, x.dtype)
     
     for epoch in range(epochs):
         model.train()
@@ -144,29 +249,26 @@ def train_model(
         out = model(x, adj)
         
         if loss_type == "smooth":
-            # 平滑性損失
-            n = adj.shape[0]
-            loss_smooth = 0.0
-            for i in range(n):
-                neigh = torch.where(adj[i] > 0)[0]
-                if len(neigh) > 0:
-                    diffs = out[i] - out[neigh]
-                    loss_smooth += diffs.pow(2).mean()
-            loss_smooth = loss_smooth / max(1, n)
+            # 平滑性損失：逐邊計算差值平方後依列加總，O(nnz) 且數值精確
+            row, col = loss_ctx["neigh_row"], loss_ctx["neigh_col"]
+            neigh_deg = loss_ctx["neigh_deg"]
+            sq_diff = out.new_zeros(n).index_add_(0, row, (out[row] - out[col]).pow(2))
+            loss_smooth = (sq_diff / neigh_deg.clamp(min=1)).sum() / max(1, n)
             
             # 方差正則化
             loss_var = -out.var()
             loss = loss_smooth + 0.1 * loss_var
             
         elif loss_type == "contrast":
-            # 對比損失
-            pos_mask = adj > 0
-            neg_mask = adj == 0
-            
-            out_sim = torch.mm(out.unsqueeze(1), out.unsqueeze(0).transpose(-1, -2)).squeeze()
+            # 對比損失：只計算配對的內積，不建立 [N, N] 相似度矩陣；負樣本每輪重新抽樣
+            pos_idx = loss_ctx["pos_idx"]
+            neg_idx = sample_negatives(loss_ctx, n)
+            h = out.view(n, -1)
+            pos_sim = (h[pos_idx[0]] * h[pos_idx[1]]).sum(-1)
+            neg_sim = (h[neg_idx[0]] * h[neg_idx[1]]).sum(-1)
             
-            pos_loss = -torch.log(torch.sigmoid(out_sim[pos_mask])).mean()
-            neg_loss = -torch.log(1 - torch.sigmoid(out_sim[neg_mask])).mean()
+            pos_loss = -F.logsigmoid(pos_sim).mean()
+            neg_loss = -F.logsigmoid(-neg_sim).mean() if neg_sim.numel() > 0 else 0.0
             loss = pos_loss + neg_loss
         else:
             loss = out.var() * -1
@@ -174,13 +276,317 @@ def train_model(
         loss.backward()
         optimizer.step()
         
-        if epoch % 10 == 0:
-            training_history.append({
-                "epoch": epoch,
-                "loss": float(loss.item())
-            })
+        losses[epoch] = loss.detach()
+    
+    loss_values = losses.cpu().tolist()
+    training_history = [
+        {"epoch": epoch, "loss": loss_values[epoch]}
+        for epoch in range(0, epochs, 10)
+    ]
+    
+    return {"final_loss": loss_values[-1], "history": training_history}
+
+# ============================================
+# 快取
+# ============================================
+
+CACHE_SIZE = 64
+
+# 圖快取的總位元組上限（稠密鄰接矩陣為 O(N^2)，只限筆數不足以控制記憶體）
+GRAPH_CACHE_BYTES = 256 * 1024 * 1024
+
+# 鄰接矩陣密度低於此值時改用稀疏 CSR 格式
+SPARSE_DENSITY = 0.1
+
+# 依內容雜湊快取：圖結構 -> (正規化鄰接矩陣, 邊數)
+_graph_cache: "OrderedDict[str, Tuple[torch.Tensor, int]]" = OrderedDict()
+# 依內容雜湊快取：圖 + 特徵 + 模型設定 -> (訓練後權重, 訓練資訊)
+_model_cache: "OrderedDict[str, Tuple[Dict[str, torch.Tensor], Dict[str, Any]]]" = OrderedDict()
+# 快取會同時被事件迴圈與批次工作執行緒存取
+_cache_lock = threading.Lock()
+
+def content_key(*parts: Any) -> str:
+    """計算輸入內容的雜湊鍵"""
+    h = hashlib.blake2b(digest_size=16)
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            h.update(str(p.shape).encode())
+            h.update(np.ascontiguousarray(p).tobytes())
+        else:
+            h.update(repr(p).encode())
+        h.update(b"|")
+    return h.hexdigest()
+
+def _lru_get(cache: OrderedDict, key: str):
+    with _cache_lock:
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key]
+
+def tensor_nbytes(t: torch.Tensor) -> int:
+    """張量佔用的位元組數（稀疏 CSR 計入索引與數值）"""
+    if t.layout == torch.sparse_csr:
+        return sum(tensor_nbytes(p) for p in (t.crow_indices(), t.col_indices(), t.values()))
+    return t.numel() * t.element_size()
+
+def _lru_put(
+    cache: OrderedDict,
+    key: str,
+    value: Any,
+    max_bytes: Optional[int] = None,
+    sizeof: Optional[Callable[[Any], int]] = None
+) -> None:
+    """放入快取並淘汰最久未使用的項目；指定 max_bytes 時同時限制總位元組數"""
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+        if max_bytes is not None:
+            total = sum(sizeof(v) for v in cache.values())
+            while cache and total > max_bytes:
+                _, evicted = cache.popitem(last=False)
+                total -= sizeof(evicted)
+
+def cached_graph(key: str, build: Callable[[], Any]) -> Tuple[torch.Tensor, int]:
+    """
+    取得正規化鄰接矩陣與邊數，命中快取時略過建圖與正規化；
+    build 可回傳 NumPy 稠密矩陣或 scipy 稀疏矩陣
+    """
+    entry = _lru_get(_graph_cache, key)
+    if entry is None:
+        A = build()
+        n = A.shape[0]
+        A_norm = normalize_adj(A)
+        if sp.issparse(A_norm):
+            if A_norm.nnz <= SPARSE_DENSITY * n * n:
+                # 直接由 CSR 結構建立，不經稠密矩陣
+                adj = torch.sparse_csr_tensor(
+                    torch.from_numpy(A_norm.indptr.astype(np.int64)),
+                    torch.from_numpy(A_norm.indices.astype(np.int64)),
+                    torch.from_numpy(A_norm.data),
+                    size=(n, n)
+                )
+            else:
+                adj = torch.from_numpy(A_norm.toarray())
+        else:
+            adj = torch.from_numpy(A_norm)
+            if np.count_nonzero(A) <= SPARSE_DENSITY * n * n:
+                adj = adj.to_sparse_csr()
+        entry = (adj, int(A.sum() - n))
+        _lru_put(
+            _graph_cache, key, entry,
+            max_bytes=GRAPH_CACHE_BYTES, sizeof=lambda e: tensor_nbytes(e[0])
+        )
+    return entry
+
+def cached_train(
+    key: str,
+    model: torch.nn.Module,
+    x: torch.Tensor,
+    adj: torch.Tensor,
+    epochs: int,
+    **kwargs
+) -> Dict[str, Any]:
+    """訓練模型，相同輸入與設定時直接載入快取的權重"""
+    if epochs <= 0:
+        return {}
+    entry = _lru_get(_model_cache, key)
+    if entry is not None:
+        state, train_info = entry
+        model.load_state_dict(state)
+        return train_info
+    train_info = train_model(model, x, adj, epochs, **kwargs)
+    state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    _lru_put(_model_cache, key, (state, train_info))
+    return train_info
+
+# ============================================
+# 批次處理
+# ============================================
+
+BATCH_MAX_SIZE = 16
+
+class MicroBatcher:
+    """
+    請求層級動態批次：並發請求先進入佇列，背景任務取出第一筆後
+    立即連同佇列中已在等待的請求（最多 max_batch 筆）一起交由單一工作執行緒處理，
+    不額外等待；每筆完成即回傳，且模型運算不阻塞事件迴圈
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[Any], Any],
+        max_batch: int = BATCH_MAX_SIZE
+    ):
+        self.fn = fn
+        self.max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, item: Any) -> Any:
+        """提交一筆請求並等待其結果"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 首次使用（或事件迴圈更換）時啟動背景任務
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            
+            await loop.run_in_executor(self._executor, self._process, loop, batch)
+
+    def _process(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        batch: List[Tuple[Any, asyncio.Future]]
+    ) -> None:
+        # 每筆完成後立即回傳結果，不讓快速請求等待同批次中較慢的請求
+        for item, future in batch:
+            try:
+                result = self.fn(item)
+            except Exception as e:
+                loop.call_soon_threadsafe(_resolve, future, False, e)
+            else:
+                loop.call_soon_threadsafe(_resolve, future, True, result)
+
+def _resolve(future: asyncio.Future, ok: bool, value: Any) -> None:
+    """於事件迴圈中設定結果（請求已取消時略過）"""
+    if future.done():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+# ============================================
+# 多行程運算
+# ============================================
+
+def available_cpus() -> int:
+    """本行程可使用的 CPU 數（依 CPU affinity，容器限制核心時不會高估）"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # 非 Linux 平台
+        return os.cpu_count() or 1
+
+COMPARE_WORKERS = min(4, available_cpus())
+
+_compare_pool: Optional[ProcessPoolExecutor] = None
+
+def _init_worker() -> None:
+    torch.set_num_threads(1)
+
+def compare_pool() -> ProcessPoolExecutor:
+    """
+    取得模型比較用的行程池（首次使用時建立）；
+    使用 spawn 以避免 fork 複製父行程的 torch 執行緒狀態
+    """
+    global _compare_pool
+    if _compare_pool is None:
+        _compare_pool = ProcessPoolExecutor(
+            max_workers=COMPARE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker
+        )
+    return _compare_pool
+
+def _warm_worker() -> None:
+    """預熱用工作：匯入本模組並以極小的圖訓練一輪，完成 torch 自動微分與最佳化器的延遲初始化"""
+    x = torch.ones(2, 1)
+    adj = torch.full((2, 2), 0.5)
+    train_model(create_model("simple", 1), x, adj, epochs=1)
+    train_model(create_model("simple", 1), x, adj.to_sparse_csr(), epochs=1)
+
+def warm_compare_pool() -> None:
+    """
+    預先啟動所有工作行程，避免首次 /gcn/compare 付出行程啟動與匯入成本；
+    只送出工作不等待完成，不延遲服務啟動
+    """
+    pool = compare_pool()
+    for _ in range(COMPARE_WORKERS):
+        pool.submit(_warm_worker)
+
+def reset_compare_pool() -> None:
+    """工作行程異常結束後行程池無法再使用，捨棄後於下次使用時重建"""
+    global _compare_pool
+    if _compare_pool is not None:
+        _compare_pool.shutdown(wait=False, cancel_futures=True)
+        _compare_pool = None
+
+def share_arrays(
+    arrays: Dict[str, np.ndarray]
+) -> Tuple[shared_memory.SharedMemory, Dict[str, Tuple[int, Tuple[int, ...], str]]]:
+    """將多個陣列放入同一塊共享記憶體，回傳記憶體區塊與各陣列的 (offset, shape, dtype)"""
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(a.nbytes for a in arrays.values())))
+    layout = {}
+    offset = 0
+    for name, a in arrays.items():
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset)[...] = a
+        layout[name] = (offset, a.shape, a.dtype.str)
+        offset += a.nbytes
+    return shm, layout
+
+def load_shared_arrays(
+    shm_name: str,
+    layout: Dict[str, Tuple[int, Tuple[int, ...], str]]
+) -> Dict[str, np.ndarray]:
+    """從共享記憶體讀出陣列；複製後立即關閉對應，由建立者負責釋放"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return {
+            name: np.ndarray(shape, np.dtype(dtype), buffer=shm.buf, offset=offset).copy()
+            for name, (offset, shape, dtype) in layout.items()
+        }
+    finally:
+        shm.close()
+
+def compare_worker(
+    model_type: str,
+    shm_name: str,
+    layout: Dict[str, Tuple[int, Tuple[int, ...], str]],
+    epochs: int,
+    cache_key: str
+) -> List[float]:
+    """在行程池中訓練並評分單一模型，回傳正規化分數"""
+    arrays = load_shared_arrays(shm_name, layout)
+    x = torch.from_numpy(arrays["x"])
+    n = x.shape[0]
+    if "adj" in arrays:
+        adj = torch.from_numpy(arrays["adj"])
+    else:
+        adj = torch.sparse_csr_tensor(
+            torch.from_numpy(arrays["crow"]),
+            torch.from_numpy(arrays["col"]),
+            torch.from_numpy(arrays["values"]),
+            size=(n, n)
+        )
+    
+    model = create_model(model_type, in_feats=x.shape[1])
+    cached_train(cache_key, model, x, adj, epochs)
+    
+    model.eval()
+    with torch.inference_mode():
+        scores = model(x, adj).cpu().numpy()
     
-    return {"final_loss": float(loss.item()), "history": training_history}
+    return normalize_scores(scores)
 
 # ============================================
 # API 端點
@@ -194,6 +600,7 @@ async def root():
         "version": "2.0.0",
         "endpoints": [
             "/gcn/predict",
+            "/gcn/predict/msgpack",
             "/gcn/advanced",
             "/gcn/compare",
             "/gcn/cluster",
@@ -212,49 +619,125 @@ async def health_check():
         "cuda_available": torch.cuda.is_available()
     }
 
+def run_predict(req: GCNRequest) -> Dict[str, Any]:
+    """執行基本 GCN 預測（於批次工作執行緒中執行）"""
+    nodes = req.nodes
+    X = feature_matrix(req.features, len(req.nodes))
+    edges = req.adjacency
+    n, f = X.shape
+    
+    if n == 0:
+        return {"scores": {}, "info": {"error": "no nodes"}}
+    
+    graph_key = content_key("edges", n, edges)
+    adj_cpu, _ = cached_graph(graph_key, lambda: build_adj_matrix(n, edges))
+    
+    device = torch.device('cpu')
+    x = torch.from_numpy(X).to(device)
+    adj_norm = adj_cpu.to(device)
+    
+    model = create_model("simple", in_feats=f, hidden=max(16, f * 2), out_feats=1)
+    model.to(device)
+    
+    train_info = cached_train(
+        content_key("predict", graph_key, X, req.train_epochs),
+        model, x, adj_norm, req.train_epochs
+    )
+    
+    model.eval()
+    with torch.inference_mode():
+        scores_tensor = model(x, adj_norm).cpu().numpy()
+    
+    norm_scores = normalize_scores(scores_tensor)
+    scores = dict(zip(nodes, norm_scores))
+    
+    info = {
+        "n_nodes": n,
+        "n_features": f,
+        "train_epochs": req.train_epochs,
+        "training": train_info
+    }
+    
+    return {"scores": scores, "info": info}
+
+predict_batcher = MicroBatcher(run_predict)
+
 @app.post("/gcn/predict", response_model=GCNResponse)
 async def gcn_predict(req: GCNRequest):
     """基本 GCN 預測（向後相容）"""
     try:
-        nodes = req.nodes
-        X = np.array(req.features, dtype=np.float32)
-        edges = req.adjacency
-        n, f = X.shape
-        
-        if n == 0:
-            return {"scores": {}, "info": {"error": "no nodes"}}
-        
-        A = build_adj_matrix(n, edges)
-        A_norm = normalize_adj(A)
-        
-        device = torch.device('cpu')
-        x = torch.from_numpy(X).to(device)
-        adj_norm = torch.from_numpy(A_norm).to(device)
-        
-        model = SimpleGCN(in_feats=f, hidden=max(16, f * 2), out_feats=1)
-        model.to(device)
-        
-        if req.train_epochs > 0:
-            train_info = train_model(model, x, adj_norm, req.train_epochs)
-        else:
-            train_info = {}
-        
-        model.eval()
-        with torch.no_grad():
-            scores_tensor = model(x, adj_norm).cpu().numpy()
-        
-        norm_scores = normalize_scores(scores_tensor)
-        scores = {nodes[i]: float(norm_scores[i]) for i in range(n)}
-        
-        info = {
-            "n_nodes": n,
-            "n_features": f,
-            "train_epochs": req.train_epochs,
-            "training": train_info
-        }
+        return await predict_batcher.submit(req)
         
-        return {"scores": scores, "info": info}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"GCN predict error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def msgpack_request(data: Any) -> GCNRequest:
+    """檢查 msgpack 請求的欄位型別與形狀（不逐元素驗證），不符時回傳 422"""
+    if not isinstance(data, dict) or not all(isinstance(k, str) for k in data):
+        raise HTTPException(status_code=422, detail="請求本體須為以字串為鍵的 map")
+    if not {"nodes", "features", "adjacency"} <= data.keys():
+        raise HTTPException(status_code=422, detail="需要 nodes, features, adjacency 欄位")
+    
+    nodes, features, adjacency = data["nodes"], data["features"], data["adjacency"]
+    train_epochs = data.get("train_epochs", 0)
+    if not isinstance(nodes, list) or not isinstance(adjacency, list):
+        raise HTTPException(status_code=422, detail="nodes 與 adjacency 須為陣列")
+    if not isinstance(train_epochs, int) or isinstance(train_epochs, bool):
+        raise HTTPException(status_code=422, detail="train_epochs 須為整數")
+    if not all(isinstance(node, str) for node in nodes):
+        raise HTTPException(status_code=422, detail="nodes 須為字串陣列")
+    if not all(
+        isinstance(pair, list) and all(isinstance(i, int) for i in pair)
+        for pair in adjacency
+    ):
+        raise HTTPException(status_code=422, detail="adjacency 須為整數配對組成的陣列")
+    
+    n = len(nodes)
+    if isinstance(features, bytes):
+        if n > 0 and len(features) % (4 * n) != 0:
+            raise HTTPException(
+                status_code=422,
+                detail=f"features 位元組長度 {len(features)} 無法整除為 {n} 列 float32"
+            )
+    elif isinstance(features, list):
+        if len(features) != n:
+            raise HTTPException(
+                status_code=422,
+                detail=f"特徵列數 {len(features)} 與節點數 {n} 不符"
+            )
+    else:
+        raise HTTPException(status_code=422, detail="features 須為陣列或 float32 位元組")
+    
+    return GCNRequest.model_construct(
+        nodes=nodes, features=features, adjacency=adjacency, train_epochs=train_epochs
+    )
+
+@app.post("/gcn/predict/msgpack", response_model=GCNResponse)
+async def gcn_predict_msgpack(request: Request):
+    """
+    基本 GCN 預測（msgpack 請求本體）
+    欄位同 /gcn/predict，features 可為巢狀串列或 float32 原始位元組；
+    略過 Pydantic 逐元素驗證，只檢查必要欄位與形狀
+    """
+    try:
+        import msgpack
+    except ImportError:
+        raise HTTPException(status_code=501, detail="msgpack 未安裝")
+    
+    try:
+        data = msgpack.unpackb(await request.body(), strict_map_key=False)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"無效的 msgpack 資料: {str(e)}")
+    
+    req = msgpack_request(data)
+    try:
+        return await predict_batcher.submit(req)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"GCN predict error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -264,7 +747,7 @@ async def gcn_advanced(req: AdvancedGCNRequest):
     """進階 GCN 預測"""
     try:
         nodes = req.nodes
-        X = np.array(req.features, dtype=np.float32)
+        X = feature_matrix(req.features, len(req.nodes))
         n, f = X.shape
         
         if n == 0:
@@ -272,23 +755,25 @@ async def gcn_advanced(req: AdvancedGCNRequest):
         
         # 建立圖結構
         if req.adjacency:
-            A = build_adj_matrix(n, req.adjacency)
+            graph_key = content_key("edges", n, req.adjacency)
+            build = lambda: build_adj_matrix(n, req.adjacency)
         elif req.returns:
             returns = np.array(req.returns, dtype=np.float32)
-            A = build_correlation_graph(returns, req.correlation_threshold)
-            A = A + np.eye(n)  # 加入自環
+            graph_key = content_key("corr", returns, req.correlation_threshold)
+            build = lambda: add_self_loops(build_correlation_graph(returns, req.correlation_threshold))
         elif req.use_knn_graph:
-            A = build_knn_graph(X, req.knn_k)
-            A = A + np.eye(n)
+            graph_key = content_key("knn", X, req.knn_k)
+            build = lambda: add_self_loops(build_knn_graph(X, req.knn_k, sparse=True))
         else:
             # 全連接圖
-            A = np.ones((n, n), dtype=np.float32)
+            graph_key = content_key("full", n)
+            build = lambda: np.ones((n, n), dtype=np.float32)
         
-        A_norm = normalize_adj(A)
+        adj_cpu, n_edges = cached_graph(graph_key, build)
         
         device = torch.device('cpu')
         x = torch.from_numpy(X).to(device)
-        adj = torch.from_numpy(A_norm).to(device)
+        adj = adj_cpu.to(device)
         
         # 建立模型
         model = create_model(
@@ -301,19 +786,21 @@ async def gcn_advanced(req: AdvancedGCNRequest):
         model.to(device)
         
         # 訓練
-        train_info = {}
-        if req.train_epochs > 0:
-            train_info = train_model(
-                model, x, adj, req.train_epochs, req.learning_rate
-            )
+        train_info = cached_train(
+            content_key(
+                "advanced", graph_key, X, req.model_type, req.hidden_dim,
+                req.dropout, req.train_epochs, req.learning_rate
+            ),
+            model, x, adj, req.train_epochs, lr=req.learning_rate
+        )
         
         # 預測
         model.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             scores_tensor = model(x, adj).cpu().numpy()
         
         norm_scores = normalize_scores(scores_tensor)
-        scores = {nodes[i]: float(norm_scores[i]) for i in range(n)}
+        scores = dict(zip(nodes, norm_scores))
         
         # 排序
         ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
@@ -325,12 +812,14 @@ async def gcn_advanced(req: AdvancedGCNRequest):
             "info": {
                 "n_nodes": n,
                 "n_features": f,
-                "n_edges": int(A.sum() - n),
+                "n_edges": n_edges,
                 "train_epochs": req.train_epochs,
                 "training": train_info
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Advanced GCN error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -340,7 +829,7 @@ async def gcn_compare(req: MultiModelRequest):
     """多模型比較"""
     try:
         nodes = req.nodes
-        X = np.array(req.features, dtype=np.float32)
+        X = feature_matrix(req.features, len(req.nodes))
         n, f = X.shape
         
         if n == 0:
@@ -348,44 +837,61 @@ async def gcn_compare(req: MultiModelRequest):
         
         # 建立圖
         if req.adjacency:
-            A = build_adj_matrix(n, req.adjacency)
+            graph_key = content_key("edges", n, req.adjacency)
+            build = lambda: build_adj_matrix(n, req.adjacency)
         elif req.returns:
             returns = np.array(req.returns, dtype=np.float32)
-            A = build_correlation_graph(returns, 0.3)
-            A = A + np.eye(n)
+            graph_key = content_key("corr", returns, 0.3)
+            build = lambda: add_self_loops(build_correlation_graph(returns, 0.3))
         else:
-            A = np.ones((n, n), dtype=np.float32)
-        
-        A_norm = normalize_adj(A)
+            graph_key = content_key("full", n)
+            build = lambda: np.ones((n, n), dtype=np.float32)
         
-        device = torch.device('cpu')
-        x = torch.from_numpy(X).to(device)
-        adj = torch.from_numpy(A_norm).to(device)
+        adj, _ = cached_graph(graph_key, build)
         
         results = {}
         
-        for model_type in req.model_types:
-            try:
-                model = create_model(model_type, in_feats=f)
-                model.to(device)
-                
-                if req.train_epochs > 0:
-                    train_model(model, x, adj, req.train_epochs)
-                
-                model.eval()
-                with torch.no_grad():
-                    scores = model(x, adj).cpu().numpy()
-                
-                norm_scores = normalize_scores(scores)
-                results[model_type] = {
-                    "scores": {nodes[i]: float(norm_scores[i]) for i in range(n)},
-                    "top5": sorted(
-                        [(nodes[i], norm_scores[i]) for i in range(n)],
-                        key=lambda x: x[1], reverse=True
-                    )[:5]
-                }
-            except Exception as e:
-                results[model_type] = {"error": str(e)}
+        # 各模型互相獨立，交由行程池平行訓練；特徵與鄰接矩陣經共享記憶體傳遞
+        if adj.layout == torch.sparse_csr:
+            shared = {
+                "x": X,
+                "crow": adj.crow_indices().numpy(),
+                "col": adj.col_indices().numpy(),
+                "values": adj.values().numpy()
+            }
+        else:
+            shared = {"x": X, "adj": adj.numpy()}
+        shm, layout = share_arrays(shared)
+        
+        try:
+            pool = compare_pool()
+            futures = {
+                model_type: pool.submit(
+                    compare_worker, model_type, shm.name, layout, req.train_epochs,
+                    content_key("compare", graph_key, X, model_type, req.train_epochs)
+                )
+                for model_type in req.model_types
+            }
+            for model_type, future in futures.items():
+                try:
+                    norm_scores = await asyncio.wrap_future(future)
+                    results[model_type] = {
+                        "scores": dict(zip(nodes, norm_scores)),
+                        "top5": sorted(
+                            zip(nodes, norm_scores),
+                            key=lambda x: x[1], reverse=True
+                        )[:5]
+                    }
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        reset_compare_pool()
+                    results[model_type] = {"error": str(e)}
+        except BrokenProcessPool:
+            reset_compare_pool()
+            raise
+        finally:
+            shm.close()
+            shm.unlink()
         
         # 計算模型間一致性
         if len(results) >= 2:
@@ -414,6 +920,8 @@ async def gcn_compare(req: MultiModelRequest):
             "n_features": f
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Compare error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -426,7 +934,7 @@ async def gcn_cluster(req: StockClusterRequest):
         from sklearn.decomposition import PCA
         
         nodes = req.nodes
-        X = np.array(req.features, dtype=np.float32)
+        X = feature_matrix(req.features, len(req.nodes))
         n, f = X.shape
         
         if n < req.n_clusters:
@@ -478,6 +986,8 @@ async def gcn_cluster(req: StockClusterRequest):
             "n_clusters": req.n_clusters
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Cluster error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -487,7 +997,7 @@ async def feature_importance(req: FeatureImportanceRequest):
     """特徵重要性分析"""
     try:
         nodes = req.nodes
-        X = np.array(req.features, dtype=np.float32)
+        X = feature_matrix(req.features, len(req.nodes))
         n, f = X.shape
         
         if len(req.feature_names) != f:
@@ -496,26 +1006,26 @@ async def feature_importance(req: FeatureImportanceRequest):
                 detail=f"特徵名稱數量 {len(req.feature_names)} 與特徵數 {f} 不符"
             )
         
-        A = build_adj_matrix(n, req.adjacency)
-        A_norm = normalize_adj(A)
+        graph_key = content_key("edges", n, req.adjacency)
+        adj_cpu, _ = cached_graph(graph_key, lambda: build_adj_matrix(n, req.adjacency))
         
         device = torch.device('cpu')
         x = torch.from_numpy(X).to(device)
-        adj = torch.from_numpy(A_norm).to(device)
+        adj = adj_cpu.to(device)
         
-        model = SimpleGCN(in_feats=f, hidden=32, out_feats=1)
+        model = create_model("simple", in_feats=f, hidden=32, out_feats=1)
         model.to(device)
         
         # 訓練模型
-        train_model(model, x, adj, epochs=100)
+        cached_train(content_key("importance", graph_key, X), model, x, adj, epochs=100)
         
-        # 特徵重要性（梯度方法）
+        # 特徵重要性（梯度方法）：只對輸入求一次 VJP，不累積參數梯度
         model.eval()
-        x.requires_grad = True
-        out = model(x, adj)
-        out.sum().backward()
+        x_in = x.detach().requires_grad_(True)
+        out = model(x_in, adj)
+        (grad_x,) = torch.autograd.grad(out.sum(), x_in)
         
-        gradients = x.grad.abs().mean(dim=0).cpu().numpy()
+        gradients = grad_x.abs().mean(dim=0).cpu().numpy()
         
         # 正規化
         importance = gradients / gradients.sum()
@@ -532,6 +1042,8 @@ async def feature_importance(req: FeatureImportanceRequest):
             "method": "gradient_based"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Importance error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
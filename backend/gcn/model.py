@@ -3,17 +3,31 @@ GCN 模型模組 - 擴展版
 包含多種圖神經網路架構和工具函數
 """
 
+import contextlib
+import math
+import threading
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict, Type, Union
 
 
 # ============================================
 # 基礎 GCN 層
 # ============================================
 
+def graph_matmul(adj: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    """
+    鄰接矩陣乘法：稀疏 (COO/CSR) 鄰接矩陣使用 torch.sparse.mm，
+    記憶體存取量由 O(N^2) 降為 O(nnz)
+    """
+    if adj.layout != torch.strided:
+        return torch.sparse.mm(adj, x)
+    return torch.matmul(adj, x)
+
+
 class GraphConvLayer(nn.Module):
     """基礎圖卷積層"""
     
@@ -22,9 +36,9 @@ class GraphConvLayer(nn.Module):
         self.in_features = in_features
         self.out_features = out_features
         
-        self.weight = nn.Parameter(torch.FloatTensor(in_features, out_features))
+        self.weight = nn.Parameter(torch.empty(in_features, out_features))
         if bias:
-            self.bias = nn.Parameter(torch.FloatTensor(out_features))
+            self.bias = nn.Parameter(torch.empty(out_features))
         else:
             self.register_parameter('bias', None)
         
@@ -40,12 +54,12 @@ class GraphConvLayer(nn.Module):
         前向傳播
         Args:
             x: 節點特徵 [N, in_features]
-            adj: 鄰接矩陣 [N, N]
+            adj: 鄰接矩陣 [N, N]（可為稀疏 CSR）
         Returns:
             輸出特徵 [N, out_features]
         """
         support = torch.mm(x, self.weight)
-        output = torch.mm(adj, support)
+        output = graph_matmul(adj, support)
         
         if self.bias is not None:
             output = output + self.bias
@@ -71,8 +85,8 @@ class GraphAttentionLayer(nn.Module):
         self.alpha = alpha
         self.concat = concat
         
-        self.W = nn.Parameter(torch.FloatTensor(in_features, out_features))
-        self.a = nn.Parameter(torch.FloatTensor(2 * out_features, 1))
+        self.W = nn.Parameter(torch.empty(in_features, out_features))
+        self.a = nn.Parameter(torch.empty(2 * out_features, 1))
         
         self.leakyrelu = nn.LeakyReLU(self.alpha)
         self.reset_parameters()
@@ -90,16 +104,17 @@ class GraphAttentionLayer(nn.Module):
         Returns:
             輸出特徵 [N, out_features]
         """
-        N = x.size(0)
         h = torch.mm(x, self.W)  # [N, out_features]
         
-        # 計算注意力係數
-        a_input = torch.cat([
-            h.repeat(1, N).view(N * N, -1),
-            h.repeat(N, 1)
-        ], dim=1).view(N, N, 2 * self.out_features)
+        # 注意力需要完整的 [N, N] 遮罩
+        if adj.layout != torch.strided:
+            adj = adj.to_dense()
         
-        e = self.leakyrelu(torch.matmul(a_input, self.a).squeeze(2))
+        # 計算注意力係數：a^T [h_i || h_j] = a_l^T h_i + a_r^T h_j，
+        # 避免建立 [N, N, 2 * out_features] 的中間張量
+        el = torch.mm(h, self.a[:self.out_features])  # [N, 1]
+        er = torch.mm(h, self.a[self.out_features:])  # [N, 1]
+        e = self.leakyrelu(el + er.t())
         
         # 遮罩非鄰接節點
         zero_vec = -9e15 * torch.ones_like(e)
@@ -128,10 +143,10 @@ class SimpleGCN(nn.Module):
         self.fc2 = nn.Linear(hidden, out_feats)
     
     def forward(self, x: torch.Tensor, adj_norm: torch.Tensor) -> torch.Tensor:
-        h = torch.matmul(adj_norm, x)
+        h = graph_matmul(adj_norm, x)
         h = self.fc1(h)
         h = F.relu(h)
-        h = torch.matmul(adj_norm, h)
+        h = graph_matmul(adj_norm, h)
         h = self.fc2(h)
         return h.squeeze(-1)
 
@@ -155,22 +170,20 @@ class DeepGCN(nn.Module):
         # 建立層
         dims = [in_feats] + hidden_dims
         self.convs = nn.ModuleList()
-        self.bns = nn.ModuleList() if use_bn else None
+        self.bns = nn.ModuleList()
         
         for i in range(len(dims) - 1):
             self.convs.append(GraphConvLayer(dims[i], dims[i + 1]))
-            if use_bn:
-                self.bns.append(nn.BatchNorm1d(dims[i + 1]))
+            # 不使用 BN 時以 Identity 佔位，forward 可直接 zip
+            self.bns.append(nn.BatchNorm1d(dims[i + 1]) if use_bn else nn.Identity())
         
         # 輸出層
         self.out_layer = nn.Linear(hidden_dims[-1], out_feats)
     
     def forward(self, x: torch.Tensor, adj: torch.Tensor) -> torch.Tensor:
         """前向傳播"""
-        for i, conv in enumerate(self.convs):
-            x = conv(x, adj)
-            if self.use_bn:
-                x = self.bns[i](x)
+        for conv, bn in zip(self.convs, self.bns):
+            x = bn(conv(x, adj))
             x = F.relu(x)
             x = F.dropout(x, self.dropout, training=self.training)
         
@@ -250,12 +263,6 @@ class HybridGCN(nn.Module):
             nn.Dropout(dropout),
             nn.Linear(gcn_hidden, out_feats)
         )
-        
-        # 注意力權重
-        self.attention = nn.Sequential(
-            nn.Linear(gcn_hidden * 2, 2),
-            nn.Softmax(dim=-1)
-        )
     
     def forward(self, x: torch.Tensor, adj: torch.Tensor) -> torch.Tensor:
         """前向傳播"""
@@ -267,14 +274,9 @@ class HybridGCN(nn.Module):
         # MLP 分支
         h_mlp = self.mlp(x)
         
-        # 注意力加權融合
+        # 融合輸出
         combined = torch.cat([h_gcn, h_mlp], dim=-1)
-        weights = self.attention(combined)
-        
-        h_fused = weights[:, 0:1] * h_gcn + weights[:, 1:2] * h_mlp
-        
-        # 輸出
-        out = self.fusion(torch.cat([h_gcn, h_mlp], dim=-1))
+        out = self.fusion(combined)
         return out.squeeze(-1)
 
 
@@ -357,9 +359,8 @@ def normalize_adjacency(adj: torch.Tensor) -> torch.Tensor:
     degree_inv_sqrt = torch.pow(degree, -0.5)
     degree_inv_sqrt[torch.isinf(degree_inv_sqrt)] = 0
     
-    # 正規化
-    D_inv_sqrt = torch.diag(degree_inv_sqrt)
-    return torch.mm(torch.mm(D_inv_sqrt, adj), D_inv_sqrt)
+    # 正規化（以廣播取代對角矩陣乘法）
+    return adj * degree_inv_sqrt.unsqueeze(1) * degree_inv_sqrt.unsqueeze(0)
 
 
 def build_correlation_graph(
@@ -376,8 +377,12 @@ def build_correlation_graph(
     Returns:
         鄰接矩陣 [N, N]
     """
-    # 計算相關性矩陣
-    corr_matrix = np.corrcoef(returns)
+    # 計算相關性矩陣：標準化後以單一 GEMM 計算（維持輸入精度，float32 走 SGEMM）
+    returns = np.asarray(returns)
+    returns = returns.astype(np.result_type(returns.dtype, np.float32), copy=False)
+    z = returns - returns.mean(axis=1, keepdims=True)
+    z /= z.std(axis=1, keepdims=True) + 1e-12
+    corr_matrix = (z @ z.T) / z.shape[1]
     
     # 根據閾值建立鄰接矩陣
     adj = (np.abs(corr_matrix) > threshold).astype(np.float32)
@@ -396,41 +401,56 @@ def build_sector_graph(sectors: List[str]) -> np.ndarray:
     Returns:
         鄰接矩陣 [N, N]
     """
-    n = len(sectors)
-    adj = np.zeros((n, n), dtype=np.float32)
-    
-    for i in range(n):
-        for j in range(i + 1, n):
-            if sectors[i] == sectors[j]:
-                adj[i, j] = 1
-                adj[j, i] = 1
+    # 產業字串轉為整數代碼後以廣播比較
+    _, codes = np.unique(np.asarray(sectors), return_inverse=True)
+    codes = codes.ravel()
+    adj = (codes[:, None] == codes[None, :]).astype(np.float32)
+    np.fill_diagonal(adj, 0)  # 移除自環
     
     return adj
 
 
 def build_knn_graph(
     features: np.ndarray,
-    k: int = 5
-) -> np.ndarray:
+    k: int = 5,
+    sparse: bool = False
+):
     """
     基於 K 近鄰建立股票關係圖
     
     Args:
         features: 特徵矩陣 [N, F]
         k: 近鄰數量
+        sparse: 是否回傳 scipy CSR 稀疏矩陣
     
     Returns:
         鄰接矩陣 [N, N]
     """
-    from sklearn.neighbors import kneighbors_graph
-    
-    adj = kneighbors_graph(features, k, mode='connectivity', include_self=False)
-    adj = adj.toarray()
+    from scipy import sparse as sp
+    
+    X = np.asarray(features)
+    X = X.astype(np.result_type(X.dtype, np.float32), copy=False)
+    n = X.shape[0]
+    if not 0 < k < n:
+        raise ValueError(f"k must be in [1, {n - 1}] for {n} nodes, got {k}")
+    
+    # 平方歐氏距離 |x_i|^2 + |x_j|^2 - 2 x_i·x_j，內積以 BLAS 計算
+    sq_norm = np.einsum('ij,ij->i', X, X)
+    dist = sq_norm[:, None] + sq_norm[None, :] - 2.0 * (X @ X.T)
+    np.fill_diagonal(dist, np.inf)  # 排除自身
+    
+    # 每列只做部分選取，不需完整排序
+    neighbors = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    rows = np.repeat(np.arange(n), k)
+    adj = sp.csr_matrix(
+        (np.ones(n * k, dtype=np.float32), (rows, neighbors.ravel())),
+        shape=(n, n)
+    )
     
     # 轉為無向圖
-    adj = np.maximum(adj, adj.T)
+    adj = adj.maximum(adj.T).tocsr()
     
-    return adj.astype(np.float32)
+    return adj if sparse else adj.toarray()
 
 
 # ============================================
@@ -490,9 +510,20 @@ class CombinedLoss(nn.Module):
 # 模型工廠
 # ============================================
 
+_MODEL_REGISTRY: Dict[str, Type[nn.Module]] = {
+    'simple': SimpleGCN,
+    'deep': DeepGCN,
+    'gat': GATModel,
+    'hybrid': HybridGCN,
+    'temporal': TemporalGCN
+}
+
+
 def create_model(
     model_type: str,
     in_feats: int,
+    device: Optional[Union[str, torch.device]] = None,
+    stream: Optional["torch.cuda.Stream"] = None,
     **kwargs
 ) -> nn.Module:
     """
@@ -501,29 +532,210 @@ def create_model(
     Args:
         model_type: 模型類型
         in_feats: 輸入特徵數
+        device: 直接在此裝置上配置參數，免去事後 .to(device) 的複製（None 為預設裝置）
+        stream: 建構時使用的 CUDA stream（僅 CUDA 裝置有效）
         **kwargs: 其他參數
     
     Returns:
         模型實例
     """
-    models = {
-        'simple': SimpleGCN,
-        'deep': DeepGCN,
-        'gat': GATModel,
-        'hybrid': HybridGCN,
-        'temporal': TemporalGCN
-    }
-    
-    if model_type not in models:
+    cls = _MODEL_REGISTRY.get(model_type)
+    if cls is None:
         raise ValueError(f"Unknown model type: {model_type}")
     
-    return models[model_type](in_feats, **kwargs)
+    if device is None:
+        return cls(in_feats, **kwargs)
+    
+    device = torch.device(device)
+    with contextlib.ExitStack() as stack:
+        if device.type == 'cuda':
+            stack.enter_context(torch.cuda.device(device))
+            if stream is not None:
+                stack.enter_context(torch.cuda.stream(stream))
+        stack.enter_context(device)
+        return cls(in_feats, **kwargs)
 
 
 # ============================================
 # 模型評估
 # ============================================
 
+def _average_ranks(values, order, ranks):
+    """依排序結果散佈排名，相同數值取平均排名（與 rankdata 預設一致）"""
+    n = order.shape[0]
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        rank = 0.5 * (i + j)
+        for m in range(i, j + 1):
+            ranks[order[m]] = rank
+        i = j + 1
+
+
+def _eval_kernel(pred, tgt, p_order, t_order):
+    """
+    融合評估核心：排序索引由呼叫端以 NumPy 計算後傳入，單一迴圈累積所有統計量
+    
+    Returns:
+        (spearman, pearson, top20_precision, rmse)
+    """
+    n = pred.shape[0]
+    
+    rp = np.empty(n, dtype=np.float64)
+    rt = np.empty(n, dtype=np.float64)
+    _average_ranks(pred, p_order, rp)
+    _average_ranks(tgt, t_order, rt)
+    
+    # 先求平均再累積中心化乘積，避免原始平方和相減的數值抵銷
+    mean_p = 0.0
+    mean_t = 0.0
+    for i in range(n):
+        mean_p += pred[i]
+        mean_t += tgt[i]
+    mean_p /= n
+    mean_t /= n
+    mean_r = 0.5 * (n - 1)
+    
+    sum_pp = 0.0
+    sum_tt = 0.0
+    sum_pt = 0.0
+    sum_rprp = 0.0
+    sum_rtrt = 0.0
+    sum_rprt = 0.0
+    sse = 0.0
+    for i in range(n):
+        dp = pred[i] - mean_p
+        dt = tgt[i] - mean_t
+        sum_pp += dp * dp
+        sum_tt += dt * dt
+        sum_pt += dp * dt
+        drp = rp[i] - mean_r
+        drt = rt[i] - mean_r
+        sum_rprp += drp * drp
+        sum_rtrt += drt * drt
+        sum_rprt += drp * drt
+        d = pred[i] - tgt[i]
+        sse += d * d
+    
+    pearson = sum_pt / np.sqrt(sum_pp * sum_tt)
+    spearman = sum_rprt / np.sqrt(sum_rprp * sum_rtrt)
+    
+    # Top 20%：直接取排序尾端，以布林遮罩求交集
+    top_k = n // 5
+    mark = np.zeros(n, dtype=np.bool_)
+    for i in range(n - top_k, n):
+        mark[p_order[i]] = True
+    hits = 0
+    for i in range(n - top_k, n):
+        if mark[t_order[i]]:
+            hits += 1
+    precision = hits / top_k
+    
+    return spearman, pearson, precision, np.sqrt(sse / n)
+
+
+_jit_lock = threading.Lock()
+_jit_eval_kernel = None
+_jit_loaded = False
+
+
+def _load_eval_kernel():
+    """
+    首次評估時才匯入 numba 並依明確簽章編譯融合核心（cache=True 下之後由磁碟快取載入），
+    服務與工作行程匯入本模組時不需付出編譯成本；numba 為選用依賴，未安裝時回傳 None
+    """
+    global _average_ranks, _jit_eval_kernel, _jit_loaded
+    with _jit_lock:
+        if _jit_loaded:
+            return _jit_eval_kernel
+        try:
+            from numba import njit
+        except ImportError:
+            njit = None
+        if njit is not None:
+            # _eval_kernel 以全域名稱呼叫 _average_ranks，須先換成編譯後的版本
+            _average_ranks = njit(
+                ['void(f8[::1], i8[::1], f8[::1])', 'void(f4[::1], i8[::1], f8[::1])'],
+                cache=True, boundscheck=False
+            )(_average_ranks)
+            _jit_eval_kernel = njit(
+                [
+                    'UniTuple(f8, 4)(f8[::1], f8[::1], i8[::1], i8[::1])',
+                    'UniTuple(f8, 4)(f4[::1], f4[::1], i8[::1], i8[::1])'
+                ],
+                cache=True, fastmath=True, boundscheck=False
+            )(_eval_kernel)
+        _jit_loaded = True
+        return _jit_eval_kernel
+
+
+def _rank(values):
+    """
+    單次 argsort 加散佈求排名；有重複值時同名次取平均（與 rankdata 預設一致）
+    
+    Returns:
+        (排名, 排序索引)，排序索引可重複用於 Top-k
+    """
+    n = values.size
+    order = np.argsort(values)
+    ranks = np.empty(n, dtype=np.float64)
+    ranks[order] = np.arange(n)
+    
+    sorted_values = values[order]
+    tied = sorted_values[1:] == sorted_values[:-1]
+    if tied.any():
+        starts = np.flatnonzero(np.r_[True, ~tied])
+        sizes = np.diff(np.r_[starts, n])
+        ranks[order] = np.repeat(starts + 0.5 * (sizes - 1), sizes)
+    
+    return ranks, order
+
+
+def _eval_numpy(predictions, targets):
+    """
+    NumPy 評估實作（未安裝 numba 時使用）
+    
+    Returns:
+        (spearman, pearson, top20_precision, rmse)
+    """
+    # 排序相關性：排名後的 Pearson 相關（不計算用不到的 p 值）
+    rp, p_order = _rank(predictions)
+    rt, t_order = _rank(targets)
+    spearman_corr = np.corrcoef(rp, rt)[0, 1]
+    
+    # Pearson 相關（同時作為 IC）
+    pm = predictions - predictions.mean()
+    tm = targets - targets.mean()
+    pearson_corr = (pm * tm).sum() / np.sqrt((pm * pm).sum() * (tm * tm).sum())
+    
+    # 分組準確度
+    n = len(predictions)
+    top_k = n // 5  # Top 20%
+    
+    # 直接取排名用的排序尾端，以布林遮罩求交集
+    mask = np.zeros(n, dtype=bool)
+    mask[p_order[n - top_k:]] = True
+    precision = np.count_nonzero(mask[t_order[n - top_k:]]) / top_k
+    
+    # RMSE：以內積一次完成平方與加總
+    diff = predictions - targets
+    rmse = math.sqrt(float(diff @ diff) / diff.size)
+    
+    return spearman_corr, pearson_corr, precision, rmse
+
+
+def _is_constant(x: np.ndarray, axis: Optional[int] = None):
+    """
+    判斷（逐列）是否為常數：變異數相對於平均值平方低於浮點精度即視為常數，
+    與數值尺度無關，極小尺度但確有變化的輸入不會被誤判
+    """
+    finfo = np.finfo(x.dtype)
+    mean = x.mean(axis=axis)
+    return x.var(axis=axis) <= finfo.eps * np.maximum(mean * mean, finfo.tiny)
+
+
 def evaluate_predictions(
     predictions: np.ndarray,
     targets: np.ndarray
@@ -538,31 +750,111 @@ def evaluate_predictions(
     Returns:
         評估指標
     """
-    from scipy import stats
+    # 保留輸入浮點 dtype（如 float32），僅在兩者不一致或非浮點時提升為共同型別
+    predictions = np.asarray(predictions)
+    targets = np.asarray(targets)
+    dtype = np.result_type(predictions, targets, np.float32)
+    predictions = np.ascontiguousarray(predictions, dtype=dtype)
+    targets = np.ascontiguousarray(targets, dtype=dtype)
+    
+    # 常數輸入（如訓練初期模型塌縮）：相關性無定義，直接回傳 0 並只計算 RMSE
+    if _is_constant(predictions) or _is_constant(targets):
+        diff = predictions - targets
+        return {
+            'spearman_corr': 0.0,
+            'pearson_corr': 0.0,
+            'top20_precision': 0.0,
+            'ic': 0.0,
+            'rmse': math.sqrt(float(diff @ diff) / diff.size)
+        }
+    
+    kernel = _load_eval_kernel()
+    if kernel is not None:
+        # 排序以 NumPy 執行（較 Numba 內建 argsort 快），核心只負責融合迴圈
+        spearman_corr, pearson_corr, precision, rmse = kernel(
+            predictions, targets, np.argsort(predictions), np.argsort(targets)
+        )
+    else:
+        spearman_corr, pearson_corr, precision, rmse = _eval_numpy(predictions, targets)
     
-    # 排序相關性
-    spearman_corr, spearman_p = stats.spearmanr(predictions, targets)
-    pearson_corr, pearson_p = stats.pearsonr(predictions, targets)
+    # IC (Information Coefficient) 即預測與實際報酬的 Pearson 相關
+    ic = float(pearson_corr) if np.isfinite(pearson_corr) else 0.0
     
-    # 分組準確度
-    n = len(predictions)
-    top_k = n // 5  # Top 20%
+    return {
+        'spearman_corr': float(spearman_corr),
+        'pearson_corr': float(pearson_corr),
+        'top20_precision': float(precision),
+        'ic': ic,
+        'rmse': float(rmse)
+    }
+
+
+def _rowwise_corr(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """逐列 Pearson 相關"""
+    am = a - a.mean(axis=1, keepdims=True)
+    bm = b - b.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (am * bm).sum(axis=1) / np.sqrt((am * am).sum(axis=1) * (bm * bm).sum(axis=1))
+
+
+def evaluate_predictions_batched(
+    predictions: np.ndarray,
+    targets: np.ndarray
+) -> dict:
+    """
+    批次評估預測結果（每列為一個交易日或一個 fold 的截面）
+    
+    Args:
+        predictions: 預測分數 [D, N]
+        targets: 真實報酬 [D, N]
     
-    pred_top = set(np.argsort(predictions)[-top_k:])
-    actual_top = set(np.argsort(targets)[-top_k:])
+    Returns:
+        評估指標，每個指標為長度 D 的陣列，語意與 evaluate_predictions 相同
+    """
+    from scipy.stats import rankdata
+    
+    predictions = np.asarray(predictions)
+    targets = np.asarray(targets)
+    dtype = np.result_type(predictions, targets, np.float32)
+    predictions = np.ascontiguousarray(predictions, dtype=dtype)
+    targets = np.ascontiguousarray(targets, dtype=dtype)
+    
+    if predictions.ndim != 2 or predictions.shape != targets.shape:
+        raise ValueError(
+            f"predictions and targets must be 2-D with the same shape, "
+            f"got {predictions.shape} and {targets.shape}"
+        )
     
-    precision = len(pred_top & actual_top) / top_k
+    d, n = predictions.shape
+    rows = np.arange(d)[:, None]
+    
+    # 排序相關性與 Pearson 相關
+    spearman_corr = _rowwise_corr(rankdata(predictions, axis=1), rankdata(targets, axis=1))
+    pearson_corr = _rowwise_corr(predictions, targets)
+    
+    # 分組準確度：逐列部分選取，以布林遮罩求交集
+    top_k = n // 5  # Top 20%
+    pred_top = np.argpartition(predictions, n - top_k, axis=1)[:, n - top_k:]
+    actual_top = np.argpartition(targets, n - top_k, axis=1)[:, n - top_k:]
     
-    # IC (Information Coefficient)
-    ic = np.corrcoef(predictions, targets)[0, 1]
+    mask = np.zeros((d, n), dtype=bool)
+    mask[rows, pred_top] = True
+    precision = np.count_nonzero(mask[rows, actual_top], axis=1) / top_k
     
     # RMSE
-    rmse = np.sqrt(np.mean((predictions - targets) ** 2))
+    diff = predictions - targets
+    rmse = np.sqrt(np.einsum('ij,ij->i', diff, diff) / n)
+    
+    # 常數列：相關性無定義，與單日版本相同回傳 0
+    constant = _is_constant(predictions, axis=1) | _is_constant(targets, axis=1)
+    spearman_corr[constant] = 0.0
+    pearson_corr[constant] = 0.0
+    precision[constant] = 0.0
     
     return {
-        'spearman_corr': float(spearman_corr),
-        'pearson_corr': float(pearson_corr),
-        'top20_precision': float(precision),
-        'ic': float(ic) if not np.isnan(ic) else 0,
-        'rmse': float(rmse)
+        'spearman_corr': spearman_corr,
+        'pearson_corr': pearson_corr,
+        'top20_precision': precision,
+        'ic': np.where(np.isfinite(pearson_corr), pearson_corr, 0.0),
+        'rmse': rmse
     }